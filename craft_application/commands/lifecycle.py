@@ -30,17 +30,10 @@ from craft_application.commands import base
 
 def get_lifecycle_command_group() -> CommandGroup:
     """Return the lifecycle related command group."""
-    commands: list[type[_BaseLifecycleCommand]] = [
-        CleanCommand,
-        PullCommand,
-        OverlayCommand,
-        BuildCommand,
-        StageCommand,
-        PrimeCommand,
-        PackCommand,
-    ]
-    if not Features().enable_overlay:
-        commands.remove(OverlayCommand)
+    commands: list[type[_BaseLifecycleCommand]] = [CleanCommand, PullCommand]
+    if Features().enable_overlay:
+        commands.append(OverlayCommand)
+    commands.extend([BuildCommand, StageCommand, PrimeCommand, PackCommand])
 
     return CommandGroup(
         "Lifecycle",
@@ -101,8 +94,8 @@ class _BaseLifecycleCommand(base.ExtensibleCommand):
             )
             return False
 
-        build_env = os.getenv("CRAFT_BUILD_ENVIRONMENT")
-        if build_env and build_env.lower().strip() == "host":
+        build_env = os.getenv("CRAFT_BUILD_ENVIRONMENT", "")
+        if build_env.strip().lower() == "host":
             emit.debug(
                 f"Not running managed mode because CRAFT_BUILD_ENVIRONMENT={build_env}"
             )
@@ -14,25 +14,33 @@
 # You should have received a copy of the GNU Lesser General Public License along
 # with this program.  If not, see <http://www.gnu.org/licenses/>.
 """Utilities to interact with the fetch-service."""
-import contextlib
+import datetime
 import io
 import logging
 import pathlib
+import random
 import shlex
 import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from dataclasses import dataclass
-from functools import cache
+from functools import cache, cached_property
 from typing import Any, cast
 
 import craft_providers
 import requests
 from craft_cli import emit
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.x509.oid import NameOID
 from pydantic import Field
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPBasicAuth
+from urllib3.util.retry import Retry
 
-from craft_application import errors, util
+from craft_application import errors
 from craft_application.models import CraftBaseModel
-from craft_application.util import retry
 
 logger = logging.getLogger(__name__)
 
@@ -65,6 +73,15 @@ _DEFAULT_CONFIG = FetchServiceConfig(
     password="craft",  # noqa: S106 (hardcoded-password-func-arg)
 )
 
+# The base URL of the fetch-service's control API.
+_CONTROL_URL = f"http://localhost:{_DEFAULT_CONFIG.control}"
+
+# How long to wait for a freshly-spawned fetch-service to come online, and the
+# bounds (in seconds) of the backoff between status checks.
+_STARTUP_TIMEOUT = 60.0
+_BACKOFF_BASE_DELAY = 0.02
+_BACKOFF_MAX_DELAY = 1.0
+
 # The path to the fetch-service's certificate inside the build instance.
 _FETCH_CERT_INSTANCE_PATH = pathlib.Path(
     "/usr/local/share/ca-certificates/local-ca.crt"
@@ -87,7 +104,7 @@ class NetInfo:
         self._gateway = _get_gateway(instance)
         self._session_data = session_data
 
-    @property
+    @cached_property
     def http_proxy(self) -> str:
         """Proxy string in the 'http://<session-id>:<session-token>@<ip>:<port>/."""
         session = self._session_data
@@ -95,7 +112,7 @@ class NetInfo:
         gw = self._gateway
         return f"http://{session.session_id}:{session.token}@{gw}:{port}/"
 
-    @property
+    @cached_property
     def env(self) -> dict[str, str]:
         """Environment variables to use for the proxy."""
         return {
@@ -179,31 +196,7 @@ def start_service() -> subprocess.Popen[str] | None:
         text=True,
     )
 
-    # Wait a bit for the service to come online
-    with contextlib.suppress(subprocess.TimeoutExpired):
-        fetch_process.wait(0.1)
-
-    if fetch_process.poll() is not None:
-        # fetch-service already exited, something is wrong
-        log = log_filepath.read_text()
-        lines = log.splitlines()
-        error_lines = [line for line in lines if "ERROR:" in line]
-        error_text = "\n".join(error_lines)
-
-        if "bind: address already in use" in error_text:
-            proxy, control = _DEFAULT_CONFIG.proxy, _DEFAULT_CONFIG.control
-            message = f"fetch-service ports {proxy} and {control} are already in use."
-            details = None
-        else:
-            message = "Error spawning the fetch-service."
-            details = error_text
-        raise errors.FetchServiceError(message, details=details)
-
-    status = retry(
-        "wait for fetch-service to come online",
-        errors.FetchServiceError,
-        get_service_status,  # pyright: ignore[reportArgumentType]
-    )
+    status = _wait_for_service(fetch_process, log_filepath)
     if "uptime" not in status:
         stop_service(fetch_process)
         raise errors.FetchServiceError(
@@ -218,6 +211,7 @@ def stop_service(fetch_process: subprocess.Popen[str]) -> None:
 
     This function first calls terminate(), and then kill() after a short time.
     """
+    close_session()
     fetch_process.terminate()
     try:
         fetch_process.wait(timeout=1.0)
@@ -255,11 +249,15 @@ def teardown_session(session_data: SessionData) -> dict[str, Any]:
     # Get session report
     session_report = _service_request("get", f"session/{session_id}", json={}).json()
 
-    # Delete session
-    _service_request("delete", f"session/{session_id}")
-
-    # Delete session resources
-    _service_request("delete", f"resources/{session_id}")
+    # Delete the session and its resources. These are independent of each
+    # other, so issue them concurrently.
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        deletions = [
+            executor.submit(_service_request, "delete", f"session/{session_id}"),
+            executor.submit(_service_request, "delete", f"resources/{session_id}"),
+        ]
+        for deletion in as_completed(deletions):
+            deletion.result()
 
     return cast(dict[str, Any], session_report)
 
@@ -270,10 +268,24 @@ def configure_instance(
     """Configure a build instance to use a given fetch-service session."""
     net_info = NetInfo(instance, session_data)
 
-    _install_certificate(instance)
+    # Push the (independent) configuration files concurrently, and then run all
+    # the commands that need them in a single call into the instance.
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        certificate = executor.submit(_install_certificate, instance)
+        apt = executor.submit(_configure_apt, instance, net_info)
+    commands = [
+        *certificate.result(),
+        *_configure_snapd(net_info),
+        *apt.result(),
+        # The directory for the pip config, which is pushed afterwards.
+        "mkdir -p /root/.pip",
+    ]
+    logger.info(
+        "Updating certificates, configuring snapd and refreshing Apt package listings"
+    )
+    _execute_run(instance, ["/bin/sh", "-c", " && ".join(commands)])
+
     _configure_pip(instance)
-    _configure_snapd(instance, net_info)
-    _configure_apt(instance, net_info)
 
     return net_info.env
 
@@ -300,19 +312,47 @@ def verify_installed() -> None:
         )
 
 
+def close_session() -> None:
+    """Close the pooled connections to the fetch-service's control API."""
+    if _get_session.cache_info().currsize:
+        _get_session().close()
+        _get_session.cache_clear()
+
+
+@cache
+def _get_session() -> requests.Session:
+    """Get the HTTP session shared by all requests to the control API.
+
+    Reusing a single session keeps the connection to the fetch-service alive
+    between requests. Idempotent requests are retried on transient server
+    errors, but connection errors are not: they mean the fetch-service isn't
+    running, and is_service_online() must report that promptly.
+    """
+    retries = Retry(
+        total=3,
+        connect=0,
+        read=0,
+        backoff_factor=0.02,
+        status_forcelist=[502, 503, 504],
+        raise_on_status=False,
+    )
+    session = requests.Session()
+    session.mount(
+        "http://",
+        HTTPAdapter(pool_connections=1, pool_maxsize=4, max_retries=retries),
+    )
+    session.auth = HTTPBasicAuth(_DEFAULT_CONFIG.username, _DEFAULT_CONFIG.password)
+    session.headers.update({"Content-type": "application/json"})
+    return session
+
+
 def _service_request(
     verb: str, endpoint: str, json: dict[str, Any] | None = None
 ) -> requests.Response:
-    headers = {
-        "Content-type": "application/json",
-    }
-    auth = HTTPBasicAuth(_DEFAULT_CONFIG.username, _DEFAULT_CONFIG.password)
     try:
-        response = requests.request(
+        response = _get_session().request(
             verb,
-            f"http://localhost:{_DEFAULT_CONFIG.control}/{endpoint}",
-            auth=auth,
-            headers=headers,
+            f"{_CONTROL_URL}/{endpoint}",
             json=json,  # Use defaults
             timeout=0.1,
         )
@@ -324,18 +364,79 @@ def _service_request(
     return response
 
 
+def _wait_for_service(
+    fetch_process: subprocess.Popen[str], log_filepath: pathlib.Path
+) -> dict[str, Any]:
+    """Poll the status of a freshly-spawned fetch-service until it responds.
+
+    The poll interval grows exponentially with "full jitter" (a random delay up
+    to the exponential bound), so that concurrent launches don't hit the
+    control port in lockstep.
+
+    :param fetch_process: The spawned fetch-service process.
+    :param log_filepath: The fetch-service's log file, used to report errors if
+      the process exits during startup.
+    :raises errors.FetchServiceError: if the process exits, or if the service
+      still can't be reached after _STARTUP_TIMEOUT seconds.
+    """
+    deadline = time.monotonic() + _STARTUP_TIMEOUT
+    attempt = 0
+    while True:
+        attempt += 1
+        emit.debug(f"Waiting for fetch-service to come online (attempt {attempt})")
+        try:
+            status = get_service_status()
+        except errors.FetchServiceError as err:
+            if fetch_process.poll() is not None:
+                # fetch-service already exited, something is wrong
+                raise _get_spawn_error(log_filepath) from err
+            if time.monotonic() >= deadline:
+                raise
+            emit.debug(str(err))
+        else:
+            # The control port can answer before binding the proxy port fails,
+            # so check that the process is still alive before reporting success.
+            if fetch_process.poll() is not None:
+                raise _get_spawn_error(log_filepath)
+            return status
+        max_delay = min(_BACKOFF_MAX_DELAY, _BACKOFF_BASE_DELAY * 2**attempt)
+        time.sleep(random.uniform(0, max_delay))  # noqa: S311 (not for crypto)
+
+
+def _get_spawn_error(log_filepath: pathlib.Path) -> errors.FetchServiceError:
+    """Get the error describing why the fetch-service exited during startup."""
+    log = log_filepath.read_text()
+    lines = log.splitlines()
+    error_lines = [line for line in lines if "ERROR:" in line]
+    error_text = "\n".join(error_lines)
+
+    if "bind: address already in use" in error_text:
+        proxy, control = _DEFAULT_CONFIG.proxy, _DEFAULT_CONFIG.control
+        message = f"fetch-service ports {proxy} and {control} are already in use."
+        details = None
+    else:
+        message = "Error spawning the fetch-service."
+        details = error_text
+    return errors.FetchServiceError(message, details=details)
+
+
 @cache
 def _get_service_base_dir() -> pathlib.Path:
     """Get the base directory to contain the fetch-service's runtime files."""
-    input_line = "sh -c 'echo $SNAP_USER_COMMON'"
+    # "echo" is a builtin, so the snap's shell prints the variable without
+    # spawning another process.
+    input_line = 'echo "$SNAP_USER_COMMON"\n'
     output = subprocess.check_output(
         ["snap", "run", "--shell", "fetch-service"], text=True, input=input_line
     )
     return pathlib.Path(output.strip())
 
 
-def _install_certificate(instance: craft_providers.Executor) -> None:
+def _install_certificate(instance: craft_providers.Executor) -> list[str]:
+    """Push the local certificate to the instance.
 
+    :return: The shell commands that update the instance's certificates db.
+    """
     logger.info("Installing certificate")
     # Push the local certificate
     cert, _key = _obtain_certificate()
@@ -344,15 +445,16 @@ def _install_certificate(instance: craft_providers.Executor) -> None:
         destination=_FETCH_CERT_INSTANCE_PATH,
     )
     # Update the certificates db
-    _execute_run(
-        instance, ["/bin/sh", "-c", "/usr/sbin/update-ca-certificates > /dev/null"]
-    )
+    return ["/usr/sbin/update-ca-certificates > /dev/null"]
 
 
 def _configure_pip(instance: craft_providers.Executor) -> None:
+    """Push the pip config to the instance.
+
+    Note: The /root/.pip directory must already exist in the instance.
+    """
     logger.info("Configuring pip")
 
-    _execute_run(instance, ["mkdir", "-p", "/root/.pip"])
     pip_config = b"[global]\ncert=/usr/local/share/ca-certificates/local-ca.crt"
     instance.push_file_io(
         destination=pathlib.Path("/root/.pip/pip.conf"),
@@ -361,21 +463,26 @@ def _configure_pip(instance: craft_providers.Executor) -> None:
     )
 
 
-def _configure_snapd(instance: craft_providers.Executor, net_info: NetInfo) -> None:
-    """Configure snapd to use the proxy and see our certificate.
+def _configure_snapd(net_info: NetInfo) -> list[str]:
+    """Get the shell commands to make snapd use the proxy and see our certificate.
 
-    Note: This *must* be called *after* _install_certificate(), to ensure that
-    when the snapd restart happens the new cert is there.
+    Note: These *must* run *after* the commands from _install_certificate(), to
+    ensure that when the snapd restart happens the new cert is there.
     """
-    logger.info("Configuring snapd")
-    _execute_run(instance, ["systemctl", "restart", "snapd"])
-    for config in ("proxy.http", "proxy.https"):
-        _execute_run(
-            instance, ["snap", "set", "system", f"{config}={net_info.http_proxy}"]
-        )
+    proxy = net_info.http_proxy
+    return [
+        "systemctl restart snapd",
+        shlex.join(
+            ["snap", "set", "system", f"proxy.http={proxy}", f"proxy.https={proxy}"]
+        ),
+    ]
+
 
+def _configure_apt(instance: craft_providers.Executor, net_info: NetInfo) -> list[str]:
+    """Push the Apt proxy config to the instance.
 
-def _configure_apt(instance: craft_providers.Executor, net_info: NetInfo) -> None:
+    :return: The shell commands that refresh the Apt package listings.
+    """
     logger.info("Configuring Apt")
     apt_config = f'Acquire::http::Proxy "{net_info.http_proxy}";\n'
     apt_config += f'Acquire::https::Proxy "{net_info.http_proxy}";\n'
@@ -385,10 +492,7 @@ def _configure_apt(instance: craft_providers.Executor, net_info: NetInfo) -> Non
         content=io.BytesIO(apt_config.encode("utf-8")),
         file_mode="0644",
     )
-    _execute_run(instance, ["/bin/rm", "-Rf", "/var/lib/apt/lists"])
-
-    logger.info("Refreshing Apt package listings")
-    _execute_run(instance, ["apt", "update"])
+    return ["/bin/rm -Rf /var/lib/apt/lists", "apt update"]
 
 
 def _get_gateway(instance: craft_providers.Executor) -> str:
@@ -397,25 +501,61 @@ def _get_gateway(instance: craft_providers.Executor) -> str:
     if not isinstance(instance, LXDInstance):
         raise TypeError("Don't know how to handle non-lxd instances")
 
-    instance_name = instance.instance_name
-    project = instance.project
+    return _lookup_gateway(instance.project, instance.instance_name)
+
+
+@cache
+def _lookup_gateway(project: str, instance_name: str) -> str:
+    """Get the gateway IP of an LXD instance's network.
+
+    The result is cached, as the network of an instance doesn't change during
+    its lifetime.
+    """
     output = subprocess.check_output(
         ["lxc", "--project", project, "config", "show", instance_name, "--expanded"],
         text=True,
     )
-    config = util.safe_yaml_load(io.StringIO(output))
-    network = config["devices"]["eth0"]["network"]
+    network = _find_eth0_network(output)
+    if network is None:
+        raise errors.FetchServiceError(
+            f"Could not find the network of instance {instance_name!r}."
+        )
 
-    route = subprocess.check_output(
-        ["ip", "route", "show", "dev", network],
-        text=True,
-    )
-    return route.strip().split()[-1]
+    # Only the last word of the output is needed, so decode just that.
+    route = subprocess.check_output(["ip", "route", "show", "dev", network])
+    return route.rsplit(maxsplit=1)[-1].decode("ascii")
 
 
+def _find_eth0_network(config: str) -> str | None:
+    """Find the network of the "eth0" device in the output of "lxc config show".
+
+    Only the ``devices.eth0.network`` key is needed, so scan the lines for it
+    instead of parsing the whole (expanded) config as YAML.
+    """
+    in_devices = in_eth0 = False
+    for line in config.splitlines():
+        stripped = line.lstrip(" ")
+        if not stripped or stripped.startswith("#"):
+            continue
+        indent = len(line) - len(stripped)
+        key, _, value = stripped.partition(":")
+        if indent == 0:
+            in_devices = key == "devices"
+            in_eth0 = False
+        elif in_devices and indent == 2:  # noqa: PLR2004
+            in_eth0 = key == "eth0"
+        elif in_eth0 and indent == 4 and key == "network":  # noqa: PLR2004
+            return value.strip().strip("\"'")
+    return None
+
+
+@cache
 def _obtain_certificate() -> tuple[pathlib.Path, pathlib.Path]:
     """Retrieve, possibly creating, the certificate and key for the fetch service.
 
+    The result is cached, so the certificate directory is only inspected once
+    per process.
+
     :return: The full paths to the self-signed certificate and its private key.
     """
     cert_dir = _get_certificate_dir()
@@ -434,59 +574,42 @@ def _obtain_certificate() -> tuple[pathlib.Path, pathlib.Path]:
     key_tmp = cert_dir / "key-tmp.pem"
     cert_tmp = cert_dir / "cert-tmp.pem"
 
-    # Create the key
-    subprocess.run(
-        [
-            "openssl",
-            "genrsa",
-            "-aes256",
-            "-passout",
-            "pass:1",
-            "-out",
-            key_tmp,
-            "4096",
-        ],
-        check=True,
-        capture_output=True,
-    )
-
-    subprocess.run(
-        [
-            "openssl",
-            "rsa",
-            "-passin",
-            "pass:1",
-            "-in",
-            key_tmp,
-            "-out",
-            key_tmp,
-        ],
-        check=True,
-        capture_output=True,
+    # Create the (unencrypted) key. This is a local CA that is only trusted by
+    # the build instances, so an EC P-256 key is plenty and far quicker to
+    # generate than RSA-4096.
+    private_key = ec.generate_private_key(ec.SECP256R1())
+    key_tmp.touch(mode=0o600)
+    key_tmp.write_bytes(
+        private_key.private_bytes(
+            encoding=serialization.Encoding.PEM,
+            format=serialization.PrivateFormat.PKCS8,
+            encryption_algorithm=serialization.NoEncryption(),
+        )
     )
 
-    # Create a certificate with the key
-    subprocess.run(
-        [
-            "openssl",
-            "req",
-            "-subj",
-            "/CN=root@localhost",
-            "-key",
-            key_tmp,
-            "-new",
-            "-x509",
-            "-days",
-            "7300",
-            "-sha256",
-            "-extensions",
-            "v3_ca",
-            "-out",
-            cert_tmp,
-        ],
-        check=True,
-        capture_output=True,
+    # Create a self-signed CA certificate with the key
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "root@localhost")])
+    public_key = private_key.public_key()
+    now = datetime.datetime.now(tz=datetime.timezone.utc)
+    certificate = (
+        x509.CertificateBuilder()
+        .subject_name(name)
+        .issuer_name(name)
+        .public_key(public_key)
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now)
+        .not_valid_after(now + datetime.timedelta(days=7300))
+        .add_extension(x509.BasicConstraints(ca=True, path_length=None), critical=True)
+        .add_extension(
+            x509.SubjectKeyIdentifier.from_public_key(public_key), critical=False
+        )
+        .add_extension(
+            x509.AuthorityKeyIdentifier.from_issuer_public_key(public_key),
+            critical=False,
+        )
+        .sign(private_key, hashes.SHA256())
     )
+    cert_tmp.write_bytes(certificate.public_bytes(serialization.Encoding.PEM))
 
     cert_tmp.rename(cert)
     key_tmp.rename(key)
@@ -14,15 +14,22 @@
 #  You should have received a copy of the GNU Lesser General Public License
 #  along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """Tests for fetch-service-related functions."""
+import base64
 import re
 import subprocess
+import textwrap
+from collections.abc import Iterator
 from pathlib import Path
 from unittest import mock
 from unittest.mock import call
 
+import craft_providers
 import pytest
 import responses
 from craft_providers.lxd import LXDInstance
+from cryptography import x509
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ec
 from responses import matchers
 
 from craft_application import errors, fetch
@@ -34,6 +41,22 @@ AUTH = fetch._DEFAULT_CONFIG.auth
 assert_requests = responses.activate(assert_all_requests_are_fired=True)
 
 
+@pytest.fixture(autouse=True)
+def clear_fetch_caches() -> Iterator[None]:
+    """Clear the cached fetch-service lookups so they don't leak between tests."""
+    cached = [
+        fetch._get_service_base_dir,
+        fetch._get_session,
+        fetch._lookup_gateway,
+        fetch._obtain_certificate,
+    ]
+    for func in cached:
+        func.cache_clear()
+    yield
+    for func in cached:
+        func.cache_clear()
+
+
 @assert_requests
 def test_get_service_status_success():
     responses.add(
@@ -58,6 +81,25 @@ def test_get_service_status_failure():
         fetch.get_service_status()
 
 
+@assert_requests
+def test_get_service_status_transient_failure():
+    responses.get(f"http://localhost:{CONTROL}/status", status=503)
+    responses.get(f"http://localhost:{CONTROL}/status", json={"uptime": 10})
+
+    assert fetch.get_service_status() == {"uptime": 10}
+
+
+@assert_requests
+def test_get_service_status_persistent_failure():
+    responses.get(f"http://localhost:{CONTROL}/status", status=503)
+
+    expected = "Error with fetch-service GET: 503 Server Error"
+    with pytest.raises(errors.FetchServiceError, match=expected):
+        fetch.get_service_status()
+
+    assert len(responses.calls) == 4
+
+
 @pytest.mark.parametrize(
     ("status", "json", "expected"),
     [
@@ -128,6 +170,80 @@ def test_start_service(mocker, tmp_path):
     )
 
 
+def test_wait_for_service_backoff(mocker):
+    mock_sleep = mocker.patch.object(fetch.time, "sleep")
+    mocker.patch.object(
+        fetch,
+        "get_service_status",
+        side_effect=[errors.FetchServiceError("down")] * 3 + [{"uptime": 10}],
+    )
+
+    fetch_process = mock.Mock(spec=subprocess.Popen)
+    fetch_process.poll.return_value = None
+
+    assert fetch._wait_for_service(fetch_process, Path("log")) == {"uptime": 10}
+
+    delays = [sleep_call.args[0] for sleep_call in mock_sleep.mock_calls]
+    assert len(delays) == 3
+    for attempt, delay in enumerate(delays, start=1):
+        assert 0 <= delay <= fetch._BACKOFF_BASE_DELAY * 2**attempt
+
+
+def test_wait_for_service_timeout(mocker):
+    mocker.patch.object(fetch, "_STARTUP_TIMEOUT", 0)
+    mocker.patch.object(
+        fetch, "get_service_status", side_effect=errors.FetchServiceError("down")
+    )
+
+    fetch_process = mock.Mock(spec=subprocess.Popen)
+    fetch_process.poll.return_value = None
+
+    with pytest.raises(errors.FetchServiceError, match="down"):
+        fetch._wait_for_service(fetch_process, Path("log"))
+
+
+@pytest.mark.parametrize(
+    ("log_text", "expected"),
+    [
+        pytest.param(
+            "ERROR: listen tcp :13444: bind: address already in use",
+            f"fetch-service ports {PROXY} and {CONTROL} are already in use.",
+            id="ports-taken",
+        ),
+        pytest.param(
+            "ERROR: something else", "Error spawning the fetch-service.", id="other"
+        ),
+    ],
+)
+def test_wait_for_service_process_exited(mocker, tmp_path, log_text, expected):
+    mock_sleep = mocker.patch.object(fetch.time, "sleep")
+    mocker.patch.object(
+        fetch, "get_service_status", side_effect=errors.FetchServiceError("down")
+    )
+    log_filepath = tmp_path / "fetch-service.log"
+    log_filepath.write_text(f"INFO: starting\n{log_text}\n")
+    fetch_process = mock.Mock(spec=subprocess.Popen)
+    fetch_process.poll.return_value = 1
+
+    with pytest.raises(errors.FetchServiceError, match=re.escape(expected)):
+        fetch._wait_for_service(fetch_process, log_filepath)
+
+    assert not mock_sleep.called
+
+
+def test_wait_for_service_process_exited_after_status(mocker, tmp_path):
+    """The control port answered, but the proxy port bind failed right after."""
+    mocker.patch.object(fetch, "get_service_status", return_value={"uptime": 0})
+    log_filepath = tmp_path / "fetch-service.log"
+    log_filepath.write_text("ERROR: listen tcp :13444: bind: address already in use\n")
+    fetch_process = mock.Mock(spec=subprocess.Popen)
+    fetch_process.poll.return_value = 1
+
+    expected = f"fetch-service ports {PROXY} and {CONTROL} are already in use."
+    with pytest.raises(errors.FetchServiceError, match=re.escape(expected)):
+        fetch._wait_for_service(fetch_process, log_filepath)
+
+
 def test_start_service_already_up(mocker):
     """If the fetch-service is already up then a new process is *not* created."""
     mock_is_online = mocker.patch.object(fetch, "is_service_online", return_value=True)
@@ -148,6 +264,43 @@ def test_start_service_not_installed(mocker):
         fetch.start_service()
 
 
+def test_stop_service_closes_session(mocker):
+    session = fetch._get_session()
+    mock_close = mocker.patch.object(session, "close")
+    fetch_process = mock.Mock(spec=subprocess.Popen)
+
+    fetch.stop_service(fetch_process)
+
+    assert fetch_process.terminate.called
+    assert mock_close.called
+    assert fetch._get_session() is not session
+
+
+def test_stop_service_no_session(mocker):
+    mock_session = mocker.patch.object(fetch.requests, "Session")
+
+    fetch.stop_service(mock.Mock(spec=subprocess.Popen))
+
+    assert not mock_session.called
+    assert fetch._get_session.cache_info().currsize == 0
+
+
+@assert_requests
+def test_service_request_headers():
+    token = base64.b64encode(AUTH.encode()).decode()
+    responses.get(
+        f"http://localhost:{CONTROL}/status",
+        json={"uptime": 10},
+        match=[
+            matchers.header_matcher(
+                {"Authorization": f"Basic {token}", "Content-type": "application/json"}
+            )
+        ],
+    )
+
+    assert fetch.get_service_status() == {"uptime": 10}
+
+
 @assert_requests
 @pytest.mark.parametrize(
     ("strict", "expected_policy"), [(True, "strict"), (False, "permissive")]
@@ -200,6 +353,35 @@ def test_teardown_session():
     fetch.teardown_session(session_data)
 
 
+@assert_requests
+def test_teardown_session_delete_failure():
+    session_data = fetch.SessionData(id="my-session-id", token="my-session-token")
+
+    responses.delete(
+        f"http://localhost:{CONTROL}/session/{session_data.session_id}/token",
+        json={},
+        status=200,
+    )
+    responses.get(
+        f"http://localhost:{CONTROL}/session/{session_data.session_id}",
+        json={},
+        status=200,
+    )
+    responses.delete(
+        f"http://localhost:{CONTROL}/session/{session_data.session_id}",
+        json={},
+        status=200,
+    )
+    responses.delete(
+        f"http://localhost:{CONTROL}/resources/{session_data.session_id}",
+        status=500,
+    )
+
+    expected = "Error with fetch-service DELETE: 500 Server Error"
+    with pytest.raises(errors.FetchServiceError, match=expected):
+        fetch.teardown_session(session_data)
+
+
 def test_configure_build_instance(mocker):
     mocker.patch.object(fetch, "_get_gateway", return_value="127.0.0.1")
     mocker.patch.object(
@@ -225,45 +407,18 @@ def test_configure_build_instance(mocker):
     default_args = {"check": True, "stdout": subprocess.PIPE, "stderr": subprocess.PIPE}
 
     # Execution calls on the instance
+    expected_script = " && ".join(
+        [
+            "/usr/sbin/update-ca-certificates > /dev/null",
+            "systemctl restart snapd",
+            f"snap set system proxy.http={expected_proxy} proxy.https={expected_proxy}",
+            "/bin/rm -Rf /var/lib/apt/lists",
+            "apt update",
+            "mkdir -p /root/.pip",
+        ]
+    )
     assert instance.execute_run.mock_calls == [
-        call(
-            ["/bin/sh", "-c", "/usr/sbin/update-ca-certificates > /dev/null"],
-            **default_args,
-        ),
-        call(
-            ["mkdir", "-p", "/root/.pip"],
-            **default_args,
-        ),
-        call(
-            ["systemctl", "restart", "snapd"],
-            **default_args,
-        ),
-        call(
-            [
-                "snap",
-                "set",
-                "system",
-                f"proxy.http={expected_proxy}",
-            ],
-            **default_args,
-        ),
-        call(
-            [
-                "snap",
-                "set",
-                "system",
-                f"proxy.https={expected_proxy}",
-            ],
-            **default_args,
-        ),
-        call(
-            ["/bin/rm", "-Rf", "/var/lib/apt/lists"],
-            **default_args,
-        ),
-        call(
-            ["apt", "update"],
-            **default_args,
-        ),
+        call(["/bin/sh", "-c", expected_script], **default_args),
     ]
 
     # Files pushed to the instance
@@ -276,18 +431,124 @@ def test_configure_build_instance(mocker):
 
     assert instance.push_file_io.mock_calls == [
         call(
-            destination=Path("/root/.pip/pip.conf"),
+            destination=Path("/etc/apt/apt.conf.d/99proxy"),
             content=mocker.ANY,
             file_mode="0644",
         ),
         call(
-            destination=Path("/etc/apt/apt.conf.d/99proxy"),
+            destination=Path("/root/.pip/pip.conf"),
             content=mocker.ANY,
             file_mode="0644",
         ),
     ]
 
 
+LXC_CONFIG = """\
+architecture: x86_64
+config:
+  image.description: ubuntu 22.04 LTS amd64
+devices:
+  eth0:
+    name: eth0
+    network: lxdbr0
+    type: nic
+  root:
+    path: /
+    pool: default
+    type: disk
+ephemeral: false
+"""
+
+
+def test_get_gateway(fake_process):
+    fake_process.register(
+        ["lxc", "--project", "my-project", "config", "show", "my-inst", "--expanded"],
+        stdout=LXC_CONFIG,
+    )
+    fake_process.register(
+        ["ip", "route", "show", "dev", "lxdbr0"],
+        stdout="10.0.0.0/24 proto kernel scope link src 10.0.0.1\n",
+    )
+    instance = mock.MagicMock(spec=LXDInstance)
+    instance.project = "my-project"
+    instance.instance_name = "my-inst"
+
+    assert fetch._get_gateway(instance) == "10.0.0.1"
+    # The gateway is cached for the instance, so no new processes are spawned.
+    assert fetch._get_gateway(instance) == "10.0.0.1"
+
+    assert len(fake_process.calls) == 2
+
+
+@pytest.mark.parametrize(
+    ("config", "expected"),
+    [
+        pytest.param(LXC_CONFIG, "lxdbr0", id="basic"),
+        pytest.param(
+            textwrap.dedent(
+                """\
+                config:
+                  user.network: not-this-one
+                  user.multiline: |
+                    devices:
+                      eth0:
+                        network: nor-this-one
+                devices:
+                  eth1:
+                    network: other-bridge
+                    type: nic
+                  eth0:
+                    name: eth0
+                    network: "my-bridge"
+                    type: nic
+                """
+            ),
+            "my-bridge",
+            id="noise",
+        ),
+        pytest.param("devices:\n  root:\n    path: /\n", None, id="no-eth0"),
+        pytest.param("devices: {}\n", None, id="no-devices"),
+    ],
+)
+def test_find_eth0_network(config, expected):
+    assert fetch._find_eth0_network(config) == expected
+
+
+def test_get_gateway_no_network(fake_process):
+    fake_process.register(
+        ["lxc", "--project", "my-project", "config", "show", "my-inst", "--expanded"],
+        stdout="devices: {}\n",
+    )
+    instance = mock.MagicMock(spec=LXDInstance)
+    instance.project = "my-project"
+    instance.instance_name = "my-inst"
+
+    expected = "Could not find the network of instance 'my-inst'."
+    with pytest.raises(errors.FetchServiceError, match=re.escape(expected)):
+        fetch._get_gateway(instance)
+
+
+def test_get_gateway_non_lxd():
+    instance = mock.MagicMock(spec_set=craft_providers.Executor)
+
+    with pytest.raises(TypeError, match="non-lxd instances"):
+        fetch._get_gateway(instance)
+
+
+def test_get_service_base_dir(fake_process):
+    stdin = []
+    fake_process.register(
+        ["snap", "run", "--shell", "fetch-service"],
+        stdout="/home/user/snap/fetch-service/common\n",
+        stdin_callable=stdin.append,
+    )
+
+    base_dir = fetch._get_service_base_dir()
+
+    assert base_dir == Path("/home/user/snap/fetch-service/common")
+    assert stdin == ['echo "$SNAP_USER_COMMON"\n']
+
+
 def test_get_certificate_dir(mocker):
     mocker.patch.object(
         fetch,
@@ -298,3 +559,37 @@ def test_get_certificate_dir(mocker):
 
     expected = Path("/home/user/snap/fetch-service/common/craft/fetch-certificate")
     assert cert_dir == expected
+
+
+def test_obtain_certificate_cached(mocker, tmp_path):
+    mock_cert_dir = mocker.patch.object(
+        fetch, "_get_certificate_dir", return_value=tmp_path
+    )
+    (tmp_path / "local-ca.pem").touch()
+    (tmp_path / "local-ca.key.pem").touch()
+
+    expected = (tmp_path / "local-ca.pem", tmp_path / "local-ca.key.pem")
+    assert fetch._obtain_certificate() == expected
+    assert fetch._obtain_certificate() == expected
+
+    mock_cert_dir.assert_called_once()
+
+
+def test_obtain_certificate_generate(mocker, tmp_path):
+    mocker.patch.object(fetch, "_get_certificate_dir", return_value=tmp_path)
+
+    cert_path, key_path = fetch._obtain_certificate()
+
+    assert cert_path == tmp_path / "local-ca.pem"
+    assert key_path == tmp_path / "local-ca.key.pem"
+    assert not (tmp_path / "cert-tmp.pem").exists()
+    assert not (tmp_path / "key-tmp.pem").exists()
+
+    key = serialization.load_pem_private_key(key_path.read_bytes(), password=None)
+    cert = x509.load_pem_x509_certificate(cert_path.read_bytes())
+
+    assert isinstance(key, ec.EllipticCurvePrivateKey)
+    assert cert.public_key() == key.public_key()
+    assert cert.subject == cert.issuer
+    assert cert.subject.rfc4514_string() == "CN=root@localhost"
+    assert cert.extensions.get_extension_for_class(x509.BasicConstraints).value.ca